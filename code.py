@@ -38,7 +38,7 @@ import board
 import microcontroller
 import analogio
 from hardware import resolve_pin, setup_buttons, setup_whammy, setup_leds
-from utils import hex_to_rgb, load_config
+from utils import hex_to_rgb, load_config, load_config_cached
 from gamepad import CustomGamepad
 from serial_handler import handle_serial
 
@@ -50,7 +50,7 @@ except Exception as e:
     print("Failed to load config.json:", e)
     raw_config = {}
 
-config = load_config(raw_config, resolve_pin)
+config = load_config_cached(raw_config, resolve_pin)
 
 gp = CustomGamepad()
 buttons = setup_buttons(config, raw_config)
@@ -227,7 +227,7 @@ if leds is not None:
 
 serial = usb_cdc.data
 serial.timeout = 0.001
-buffer = ""
+buffer = bytearray()
 mode = None
 filename = ""
 file_lines = []
@@ -4,13 +4,207 @@ __version__ = "4.0.0"
 def get_version():
     return __version__
 # Serial command handler for BGG Firmware
+import gc
 import json
 import time
-import microcontroller 
+import microcontroller
 import os
+import re
 from utils import hex_to_rgb, load_config
 from hardware import setup_leds, setup_buttons, setup_whammy, resolve_pin
 
+# Demo and pin-detection helpers are imported once here rather than inside
+# each command handler - import is idempotent but still costs a sys.modules
+# lookup per call. Guarded so a build shipped without the optional modules
+# still boots; the handlers report the missing feature instead.
+try:
+    from demo_routine import run_demo_generator
+    import demo_state
+except ImportError:
+    run_demo_generator = None
+    demo_state = None
+try:
+    from pin_detect import (
+        cancel_pin_detect, deinit_all_buttons, detect_pin, save_detected_pin
+    )
+except ImportError:
+    cancel_pin_detect = None
+
+# Let the allocator schedule collections instead of forcing them from the
+# serial hot path - a forced gc.collect() freezes the device for several ms.
+# Full collections still run when a file write completes.
+try:
+    gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
+except AttributeError:
+    pass  # gc.threshold/mem_free not available on every port
+
+# Debug output gate - print() contends with serial.write for the same USB CDC
+# endpoint, so release builds keep this False to avoid slowing transfers
+_DEBUG = False
+
+# READPIN can be polled at high rates by the Windows app, so the response
+# prefix for each button is encoded once and cached instead of rebuilding
+# an f-string + encode on every poll
+_PIN_RSP_CACHE = {}
+
+# Commands that get a smart ACK - hash lookup / one startswith call instead
+# of a ~20-term or-chain evaluated for every received line
+_ACK_EXACT = frozenset((
+    "FIRMWARE_READY?", "READY?", "READVERSION", "READDEVICENAME", "READUID",
+    "READWHAMMY", "READJOYSTICK", "LEDRESTORE", "TILTWAVE", "DEMO",
+    "CANCELPINDETECT", "REBOOT", "REBOOTBOOTSEL"
+))
+_ACK_PREFIXES = (
+    "READFILE:", "READPIN:", "PREVIEWLED:", "SETLED:", "TILTWAVE_ENABLE:",
+    "DETECTPIN:", "SAVEPIN:", "MKDIR:"
+)
+
+# PREVIEWLED base name -> config key. The protocol's -pressed/-released/
+# -active suffixes all target the same LED, so they are stripped before the
+# lookup instead of enumerating every combination in the table
+_LED_BASE = {
+    "green-fret": "GREEN_FRET_led",
+    "red-fret": "RED_FRET_led",
+    "yellow-fret": "YELLOW_FRET_led",
+    "blue-fret": "BLUE_FRET_led",
+    "orange-fret": "ORANGE_FRET_led",
+    "strum-up": "STRUM_UP_led",
+    "strum-down": "STRUM_DOWN_led"
+}
+_LED_SUFFIXES = ("-pressed", "-released", "-active")
+
+def _led_config_key(led_name):
+    n = led_name.lower()
+    for suf in _LED_SUFFIXES:
+        if n.endswith(suf):
+            n = n[:-len(suf)]
+            break
+    return _LED_BASE.get(n)
+
+# Enhanced wave colors for the TILTWAVE effect - identical palette to the
+# main firmware loop, hoisted to module scope as an immutable tuple so
+# triggering the animation allocates nothing
+_WAVE_COLORS = (
+    (0, 0, 255),      # Deep blue
+    (0, 100, 255),    # Bright blue
+    (0, 150, 255),    # Electric blue
+    (50, 200, 255),   # Cyan-blue
+    (100, 220, 255),  # Light electric blue
+    (150, 240, 255),  # Bright cyan
+    (200, 250, 255),  # Nearly white-blue
+    (255, 255, 255),  # Pure white (peak)
+    (200, 250, 255),  # Bright cyan (fade back)
+    (150, 240, 255),  # Light electric blue
+    (100, 220, 255),  # Electric blue
+    (50, 200, 255),   # Cyan-blue
+    (0, 150, 255),    # Electric blue
+    (0, 100, 255),    # Bright blue
+    (0, 50, 255),     # Deep blue
+    (0, 25, 128),     # Darker blue
+    (0, 12, 64),      # Very dark blue
+    (0, 0, 32),       # Almost off
+    (0, 0, 0)         # Off
+)
+
+# Packed per-channel byte patterns for the wave palette, built lazily per
+# pixel byte order. When the NeoPixel driver exposes its raw buffer, frames
+# are blitted with slice assignments from this table instead of boxing an
+# RGB tuple per LED and going through the pixel setter.
+_WAVE_BYTES_CACHE = {}
+
+def _wave_bytes(order):
+    wb = _WAVE_BYTES_CACHE.get(order)
+    if wb is None:
+        chan = {"R": 0, "G": 1, "B": 2}
+        wb = bytearray(len(_WAVE_COLORS) * 3)
+        for i, rgb in enumerate(_WAVE_COLORS):
+            for pos, ch in enumerate(order):
+                wb[i * 3 + pos] = rgb[chan[ch]]
+        wb = bytes(wb)
+        _WAVE_BYTES_CACHE[order] = wb
+    return wb
+
+# TILTWAVE colour-index tables, built lazily per LED count so the animation's
+# inner loop is reduced to table lookups instead of per-LED branch math
+_TILT_TABLES = {}
+
+def _tilt_color_table(led_count, max_steps=120):
+    table = _TILT_TABLES.get(led_count)
+    if table is not None:
+        return table
+    total_sweep_steps = max_steps // 3  # 3 complete sweeps
+    last_idx = len(_WAVE_COLORS) - 1
+    table = bytearray(max_steps * led_count)
+    for step in range(max_steps):
+        current_cycle_step = step % total_sweep_steps
+        wave_position = (current_cycle_step * 12) // total_sweep_steps  # 0-11 range
+        cycle_num = step // total_sweep_steps
+        row = step * led_count
+        for led_index in range(led_count):
+            # Distance from wave center, scaled LED positions
+            distance = abs(led_index * 2 - wave_position)
+            if distance == 0:
+                color_idx = 7  # Direct hit - pure white peak
+            elif distance == 1:
+                color_idx = 5 + (current_cycle_step % 3)  # Adjacent - very bright
+            elif distance == 2:
+                color_idx = 3 + (current_cycle_step % 2)  # Near - bright blue
+            elif distance <= 4:
+                color_idx = max(0, 4 - distance)  # Trailing effect
+            else:
+                color_idx = 0  # Far from wave - dim or off
+            # Sparkle effects on secondary cycles
+            if cycle_num > 0 and (led_index + step) % 7 == 0:
+                color_idx = min(last_idx, color_idx + 3)
+            table[row + led_index] = min(last_idx, max(0, color_idx))
+    _TILT_TABLES[led_count] = table
+    return table
+
+# Constant serial replies, encoded once at import - the hot paths write
+# these directly instead of rebuilding f-strings per command
+_ACK_PREFIX = b"ACK: "
+_REPLY_UNKNOWN = b"ERROR: Unknown command\n"
+_SUFFIX_END = b"\nEND\n"
+_ERR_INVALID_SETLED = b"ERROR: Invalid SETLED format\n"
+_ERR_PRESETS_WRITE = b"ERROR: Invalid user_presets.json structure, write rejected\n"
+_ERR_PRESETS_MERGE = b"ERROR: Invalid user_presets.json structure, merge rejected\n"
+
+def _valid_presets(d):
+    """Validate a user_presets.json payload before it is written.
+
+    Explicit loop with one .lower() per key - cheaper than the old
+    generator expression, which lowercased each key twice and paid a
+    frame per item.
+    """
+    if not isinstance(d, dict):
+        return False
+    for k, v in d.items():
+        if not isinstance(v, dict) or not isinstance(k, str):
+            return False
+        kl = k.lower()
+        if not (kl.startswith("user ") or "preset" in kl):
+            return False
+    return True
+
+def _send_error(serial, prefix, exc, end=False):
+    """Send an ERROR reply without the f-string + encode round trip.
+
+    prefix is a bytes description (or None for a bare error); end=True
+    appends the END terminator used by the READ* commands.
+    """
+    msg = b"ERROR: "
+    if prefix:
+        msg += prefix + b": "
+    msg += str(exc).encode("utf-8")
+    serial.write(msg + (_SUFFIX_END if end else b"\n"))
+
+def _pin_response_prefix(key):
+    prefix = _PIN_RSP_CACHE.get(key)
+    if prefix is None:
+        prefix = b"PIN:" + key.encode("utf-8") + b":"
+        _PIN_RSP_CACHE[key] = prefix
+    return prefix
+
 # ===== SERIAL OPERATION LED INDICATORS =====
 # Global variables to store LED states during serial operations
 _serial_indicator_active = False
@@ -64,41 +258,70 @@ def stop_serial_indicator(leds):
 
 # Helper: ensure parent directory exists before writing
 # Only works for single-level subdirs (e.g. /updates/file.txt)
+# Directories verified once are cached so repeated writes into the same
+# folder skip the mkdir syscall
+_verified_dirs = set()
+
 def ensure_parent_dir_exists(filepath):
-    dirpath = "/".join(filepath.split("/")[:-1])
-    if dirpath and dirpath != "":
+    # rfind avoids building a list of path components just to rejoin them
+    idx = filepath.rfind("/")
+    dirpath = filepath[:idx] if idx > 0 else ""
+    if dirpath:
+        if dirpath in _verified_dirs:
+            return
         try:
             os.mkdir(dirpath)
         except OSError as e:
             # Directory may already exist, ignore EEXIST
             if not ("exist" in str(e).lower() or getattr(e, 'errno', None) == 17):
                 raise
+        _verified_dirs.add(dirpath)
 
 # JSON safety function - sanitizes CircuitPython data structures for reliable JSON serialization
+def _is_plain(obj):
+    return obj is None or isinstance(obj, (bool, int, float, str))
+
 def make_json_safe(obj, path="root"):
     """
     Recursively sanitizes CircuitPython objects for safe JSON serialization.
     Converts special CircuitPython types to standard Python equivalents.
+
+    Data that is already JSON-safe (the common case) is returned unchanged
+    without rebuilding the container, and no per-node path strings are
+    allocated - the path argument is kept only for call compatibility.
     """
     try:
-        if obj is None or isinstance(obj, (bool, int, float, str)):
+        if _is_plain(obj):
             return obj
         elif isinstance(obj, dict):
+            # Fast path: string-keyed dict of primitives needs no work
+            for k, v in obj.items():
+                if not isinstance(k, str) or not _is_plain(v):
+                    break
+            else:
+                return obj
             safe_dict = {}
             for k, v in obj.items():
                 # Ensure keys are strings and safe
-                safe_key = str(k) if k is not None else "null_key"
-                safe_dict[safe_key] = make_json_safe(v, f"{path}.{safe_key}")
+                safe_key = k if isinstance(k, str) else ("null_key" if k is None else str(k))
+                safe_dict[safe_key] = make_json_safe(v)
             return safe_dict
         elif isinstance(obj, (list, tuple)):
-            return [make_json_safe(item, f"{path}[{i}]") for i, item in enumerate(obj)]
+            # Fast path: a list of primitives needs no work
+            if isinstance(obj, list):
+                for item in obj:
+                    if not _is_plain(item):
+                        break
+                else:
+                    return obj
+            return [make_json_safe(item) for item in obj]
         else:
             # Convert any other type to string representation
             str_repr = str(obj)
-            print(f"JSON Safety: Converting {type(obj).__name__} to string at {path}: {str_repr[:50]}...")
+            print(f"JSON Safety: Converting {type(obj).__name__} to string: {str_repr[:50]}...")
             return str_repr
     except Exception as e:
-        print(f"JSON Safety error at {path}: {e}")
+        print(f"JSON Safety error: {e}")
         return f"<error_converting_{type(obj).__name__}>"
 
 # Atomic file write function - prevents corruption during write operations
@@ -107,8 +330,6 @@ def atomic_write_json(filepath, data):
     Safely writes JSON data using atomic operations (temp file + rename).
     Prevents file corruption if power loss occurs during write.
     """
-    import os
-    
     # Sanitize data for CircuitPython compatibility
     safe_data = make_json_safe(data, "config_root")
     
@@ -116,20 +337,32 @@ def atomic_write_json(filepath, data):
     temp_path = filepath + ".tmp"
     
     try:
-        # Write to temporary file first
+        # Write to temporary file first. json.dump streams straight into
+        # the file, avoiding a second full copy of the config in RAM that
+        # json.dumps would build.
         with open(temp_path, "w") as f:
-            import json
-            f.write(json.dumps(safe_data))
+            json.dump(safe_data, f)
             f.write("\n")  # Ensure file ends with newline
-        
-        # Atomic rename (most filesystems guarantee this is atomic)
+            f.flush()
+
+        # Push the temp file's data to flash before the rename - rename is
+        # atomic in the namespace but not durable, so without a sync a
+        # brown-out can leave the new name pointing at an empty file
+        try:
+            os.sync()
+        except AttributeError:
+            pass  # Not available on every CircuitPython port
+
+        # Atomic rename (most filesystems guarantee this is atomic).
+        # Try the overwriting rename first - removing the target up front
+        # would leave a window with no valid file on disk if power is lost.
+        # Only fall back to remove+rename on ports whose rename refuses to
+        # replace an existing file.
         try:
-            os.remove(filepath)  # CircuitPython requires explicit remove before rename
+            os.rename(temp_path, filepath)
         except OSError:
-            pass  # File might not exist, which is fine
-        
-        # This should be atomic on most filesystems
-        os.rename(temp_path, filepath)
+            os.remove(filepath)
+            os.rename(temp_path, filepath)
         print(f"Atomic JSON write completed: {filepath}")
         return True
         
@@ -142,812 +375,769 @@ def atomic_write_json(filepath, data):
             pass
         return False
 
-def handle_serial(serial, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors, buffer, mode, filename, file_lines, gp, update_leds, poll_inputs, joystick_x=None, joystick_y=None, max_bytes=8, start_tilt_wave=None):
+# ===== EXACT COMMAND DISPATCH =====
+# Stateless exact-match commands are dispatched through _EXACT_HANDLERS so
+# each one costs a single dict lookup instead of a walk down the elif chain
+# in handle_serial. Commands that change handler state (file transfers, pin
+# detection, mode switches) stay inline.
+
+def _cmd_demo(serial, env):
+    if run_demo_generator is None:
+        serial.write(b"ERROR: DEMO modules not found\n")
+        return
     try:
-        # Pre-emptive memory cleanup for large file operations
-        if mode == "write" and len(file_lines) > 8:  # ULTRA-early cleanup threshold (8 lines = ~400 bytes)
-            import gc
-            gc.collect()
-            
-        for _ in range(max_bytes):
-            if not serial.in_waiting:
-                return buffer, mode, filename, file_lines, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors
-            
-            try:
-                byte = serial.read(1)
-                if not byte:
-                    return buffer, mode, filename, file_lines, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors
-                    
-                char = byte.decode("utf-8")
-            except Exception as byte_error:
-                print(f"Error reading/decoding byte: {byte_error}")
-                # Skip this byte and continue
-                continue
+        demo_state.demo_gen = run_demo_generator(env["leds"], env["config"], env["preset_colors"], env["start_tilt_wave"])
+        serial.write(b"DEMO:STARTED\n")
+    except Exception as e:
+        _send_error(serial, b"DEMO failed", e)
 
-            if char == "\n":
-                line = buffer.rstrip("\r\n")
-                buffer = ""
-                print(f"Received: {line}")
-                
-                # Smart acknowledgment system - comprehensive for device detection and communication
-                # Skip ACKs only during file write operations to prevent corruption
-                if mode is None:  # Only send ACKs when not in file write mode
-                    # Device detection, communication, and control commands need ACKs
-                    if (line == "FIRMWARE_READY?" or line == "READY?" or 
-                        line == "READVERSION" or line == "READDEVICENAME" or 
-                        line == "READUID" or line.startswith("READFILE:") or
-                        line.startswith("READPIN:") or line.startswith("PREVIEWLED:") or
-                        line == "READWHAMMY" or line == "READJOYSTICK" or
-                        line.startswith("SETLED:") or line == "LEDRESTORE" or
-                        line == "TILTWAVE" or line.startswith("TILTWAVE_ENABLE:") or
-                        line == "DEMO" or line.startswith("DETECTPIN:") or
-                        line.startswith("SAVEPIN:") or line == "CANCELPINDETECT" or
-                        line == "REBOOT" or line == "REBOOTBOOTSEL" or
-                        line.startswith("MKDIR:")):
-                        serial.write(f"ACK: {line[:20]}\n".encode("utf-8"))
-
-                # Handle DEMO command - run LED demo routine (non-blocking)
-                if mode is None and line == "DEMO":
-                    try:
-                        from demo_routine import run_demo_generator
-                        import demo_state
-                        demo_state.demo_gen = run_demo_generator(leds, config, preset_colors, start_tilt_wave)
-                        serial.write(b"DEMO:STARTED\n")
-                    except ImportError as e:
-                        serial.write(b"ERROR: DEMO modules not found\n")
-                        print(f"DEMO import error: {e}")
-                    except Exception as e:
-                        serial.write(f"ERROR: DEMO failed: {e}\n".encode("utf-8"))
-                        print(f"DEMO error: {e}")
-                    return buffer, mode, filename, file_lines, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors
-
-                # --- Pin Detect Commands ---
-                if mode is None and line.startswith("DETECTPIN:"):
-                    from pin_detect import deinit_all_buttons, detect_pin
-                    button_name = line.split(":", 1)[1].strip()
-                    deinit_all_buttons(buttons)
-                    serial.write(f"PINDETECT:START:{button_name}\n".encode("utf-8"))
-                    detected_pin = detect_pin(button_name, duration=10)
-                    if detected_pin:
-                        serial.write(f"PINDETECT:DETECTED:{button_name}:{detected_pin}\n".encode("utf-8"))
-                    else:
-                        serial.write(f"PINDETECT:NONE:{button_name}\n".encode("utf-8"))
-                    # Reinitialize button pins after detection to avoid crash
-                    buttons = setup_buttons(config, raw_config)
-                    return buffer, mode, filename, file_lines, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors
+def _cmd_cancelpindetect(serial, env):
+    cancel_pin_detect()
+    serial.write(b"PINDETECT:CANCELLED\n")
 
-                if mode is None and line.startswith("SAVEPIN:"):
-                    from pin_detect import save_detected_pin
-                    try:
-                        _, button_name, pin_name = line.split(":")
-                        save_detected_pin("/config.json", button_name, pin_name)
-                        serial.write(f"PINDETECT:SAVED:{button_name}:{pin_name}\n".encode("utf-8"))
-                    except Exception as e:
-                        serial.write(f"PINDETECT:ERROR:{e}\n".encode("utf-8"))
-                    return buffer, mode, filename, file_lines, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors
+def _cmd_readwhammy(serial, env):
+    whammy = env["whammy"]
+    if whammy:
+        serial.write(f"WHAMMY:{whammy.value}\n".encode("utf-8"))
+    else:
+        serial.write(b"WHAMMY:-1\n")
 
-                if mode is None and line == "CANCELPINDETECT":
-                    from pin_detect import cancel_pin_detect
-                    cancel_pin_detect()
-                    serial.write(b"PINDETECT:CANCELLED\n")
-                    return buffer, mode, filename, file_lines, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors
+def _cmd_readjoystick(serial, env):
+    joystick_x = env["joystick_x"]
+    joystick_y = env["joystick_y"]
+    if joystick_x and joystick_y:
+        serial.write(f"JOYSTICK:X:{joystick_x.value}:Y:{joystick_y.value}\n".encode("utf-8"))
+    else:
+        serial.write(b"JOYSTICK:X:-1:Y:-1\n")
 
-                # Preview LED command — always handled
-                if line.startswith("PREVIEWLED:"):
-                    try:
-                        _, led_name, hex_color = line.split(":")
-                        name_map = {
-                            "green-fret": "GREEN_FRET_led",
-                            "green-fret-pressed": "GREEN_FRET_led",
-                            "green-fret-released": "GREEN_FRET_led",
-                            "red-fret": "RED_FRET_led",
-                            "red-fret-pressed": "RED_FRET_led",
-                            "red-fret-released": "RED_FRET_led",
-                            "yellow-fret": "YELLOW_FRET_led",
-                            "yellow-fret-pressed": "YELLOW_FRET_led",
-                            "yellow-fret-released": "YELLOW_FRET_led",
-                            "blue-fret": "BLUE_FRET_led",
-                            "blue-fret-pressed": "BLUE_FRET_led",
-                            "blue-fret-released": "BLUE_FRET_led",
-                            "orange-fret": "ORANGE_FRET_led",
-                            "orange-fret-pressed": "ORANGE_FRET_led",
-                            "orange-fret-released": "ORANGE_FRET_led",
-                            "strum-up": "STRUM_UP_led",
-                            "strum-up-active": "STRUM_UP_led",
-                            "strum-up-released": "STRUM_UP_led",
-                            "strum-down": "STRUM_DOWN_led",
-                            "strum-down-active": "STRUM_DOWN_led",
-                            "strum-down-released": "STRUM_DOWN_led"
-                        }
-                        led_key = name_map.get(led_name.lower())
-                        i = config.get(led_key)
-                        if i is not None and leds:
-                            rgb = hex_to_rgb(hex_color)
-                            leds[i] = rgb
-                            leds.show()
-                            print("PREVIEWLED applied")
-                            print(f"led_name: {led_name}, hex_color: {hex_color}")
-                            print(f"led_key: {led_key}, index: {i}, rgb: {rgb}")
-                        else:
-                            print(f"LED not found for key: {led_key}")
-                    except Exception as e:
-                        print("PREVIEWLED failed:", e)
-                    return buffer, mode, filename, file_lines, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors
-                # Handle READFILE commands
-                if mode is None and line.startswith("READFILE:"):
-                    filename = "/" + line.split(":", 1)[1]
-                    
-                    # Start read indicator (green strum LEDs)
-                    start_serial_indicator(leds, 'read')
-                    
-                    try:
-                        # Send START_<FILENAME> marker
-                        fname = filename.split("/")[-1]
-                        serial.write(f"START_{fname}\n".encode("utf-8"))
-                        with open(filename, "r") as f:
-                            lines = f.readlines()
-                        sent_content = False
-                        if lines:
-                            for l in lines:
-                                # Defensive: skip blank lines and FIRMWARE_READY:OK lines
-                                l_stripped = l.strip()
-                                if not l_stripped or l_stripped == "FIRMWARE_READY:OK":
-                                    continue
-                                serial.write(l.encode("utf-8"))
-                                sent_content = True
-                        # Always send END_<FILENAME> marker, even if file is empty or all lines skipped
-                        serial.write(f"END_{fname}\n".encode("utf-8"))
-                    except Exception as e:
-                        # On error, still send END_<FILENAME> for protocol consistency
-                        fname = filename.split("/")[-1]
-                        serial.write(f"ERROR: {e}\nEND_{fname}\n".encode("utf-8"))
-                    finally:
-                        # Always stop read indicator
-                        stop_serial_indicator(leds)
-                # Handle READWHAMMY command
-                elif mode is None and line == "READWHAMMY":
-                    if whammy:
-                        serial.write(f"WHAMMY:{whammy.value}\n".encode("utf-8"))
-                    else:
-                        serial.write(b"WHAMMY:-1\n")
-
-                # Handle READJOYSTICK command
-                elif mode is None and line == "READJOYSTICK":
-                    if joystick_x and joystick_y:
-                        x_val = joystick_x.value
-                        y_val = joystick_y.value
-                        serial.write(f"JOYSTICK:X:{x_val}:Y:{y_val}\n".encode("utf-8"))
-                    else:
-                        serial.write(b"JOYSTICK:X:-1:Y:-1\n")
+def _cmd_tiltwave(serial, env):
+    leds = env["leds"]
+    print("Triggering tilt wave effect")
+    try:
+        if leds is not None:
+            print("Starting exact tilt wave animation")
 
-                # Handle WRITEFILE commands with HIGH-SPEED streaming mode
-                elif mode is None and line.startswith("WRITEFILE:"):
-                    filename = "/" + line.split(":", 1)[1]
-                    file_lines = []
-                    
-                    print(f"DEBUG: WRITEFILE command received for {filename} at {time.monotonic()}")
-                    
-                    # Start write indicator (red strum LEDs)
-                    start_serial_indicator(leds, 'write')
-                    
-                    # Send initial acknowledgment for WRITEFILE - Windows app expects this
-                    serial.write(f"WRITEFILE:READY:{filename.split('/')[-1]}\n".encode("utf-8"))
-                    print(f"DEBUG: Sent WRITEFILE:READY for {filename}")
-                    
-                    # Optimized detection - use high-speed streaming for most Python files
-                    fname_lower = filename.lower()
-                    use_high_speed_streaming = (
-                        "serial_handler.py" in fname_lower or
-                        "code.py" in fname_lower or
-                        "gamepad.py" in fname_lower or
-                        "hardware.py" in fname_lower or
-                        "utils.py" in fname_lower or
-                        "demo_routine.py" in fname_lower or
-                        "demo_state.py" in fname_lower or
-                        "pin_detect.py" in fname_lower or
-                        "boot.py" in fname_lower or
-                        # Any .py file likely to be >2KB gets streaming
-                        (fname_lower.endswith(".py") and len(fname_lower) > 8)
-                    )
-                    
-                    if use_high_speed_streaming:
-                        mode = "write_stream"
-                        print(f"Starting HIGH-SPEED streaming write to {filename}")
-                        print(f"DEBUG: Entering write_stream mode for {filename}")
-                        # Send streaming mode acknowledgment
-                        serial.write(f"STREAM:READY:{filename.split('/')[-1]}\n".encode("utf-8"))
-                        print(f"DEBUG: Sent STREAM:READY for {filename}")
-                        # Open file handle immediately for high-speed streaming
-                        try:
-                            ensure_parent_dir_exists(filename)
-                            stream_file = open(filename, "w")
-                            file_lines = [stream_file]  # Store file handle in first position
-                            print(f"High-speed streaming ready for {filename}")
-                            print(f"DEBUG: File handle opened successfully for {filename}")
-                        except Exception as stream_error:
-                            print(f"DEBUG: Failed to open file handle: {stream_error}")
-                            serial.write(f"ERROR: Failed to open stream for {filename}: {stream_error}\n".encode("utf-8"))
-                            mode = "write"  # Fallback to regular mode
-                            file_lines = []
-                    else:
-                        mode = "write"
-                        print(f"Starting regular write to {filename}")
+            # Store current LED colors before starting wave. A raw-buffer
+            # strip snapshots in one bytes() copy; otherwise fall back to
+            # the per-LED tuple capture.
+            snapshot_buf = getattr(leds, "buf", None)
+            if snapshot_buf is not None:
+                stored_colors = bytes(snapshot_buf)
+            else:
+                stored_colors = [tuple(leds[i]) for i in range(len(leds))]
 
-                # Handle user preset import
-                elif mode is None and line == "IMPORTUSER":
-                    filename = "/user_presets.json"
-                    file_lines = []
-                    mode = "merge_user"
-                    print("Starting IMPORTUSER merge")
+            # Animation parameters - exact same as firmware
+            tilt_wave_max_steps = 120  # 2.4 seconds
+            led_count = len(leds)
+            tilt_wave_led_counter = 0
+            table = _tilt_color_table(led_count, tilt_wave_max_steps)
 
-                # --- Handle READPIN:<key> for button status ---
-                elif mode is None and line.startswith("READPIN:"):
-                    key = line.split(":", 1)[1].strip()
-                    print(f"[DEBUG] READPIN handler for key: {key}")
-                    pin_obj = buttons.get(key)
-                    if pin_obj:
-                        val = int(not pin_obj["obj"].value)
-                        print(f"[DEBUG] Pin value for {key}: {val}")
-                        serial.write(f"PIN:{key}:{val}\n".encode("utf-8"))
-                    else:
-                        print(f"[DEBUG] Pin not found for {key}")
-                        serial.write(f"PIN:{key}:ERR\n".encode("utf-8"))
+            # Fast path: write packed bytes straight into the strip's raw
+            # buffer when the driver exposes one (3 bytes per pixel, no
+            # brightness scaling buffer in the way)
+            raw_buf = getattr(leds, "buf", None)
+            if raw_buf is not None and len(raw_buf) == led_count * 3:
+                wave_bytes = _wave_bytes(str(getattr(leds, "byteorder", "GRB")))
+            else:
+                raw_buf = None
 
-                # Handle TILTWAVE command - trigger blue wave effect
-                elif mode is None and line == "TILTWAVE":
-                    print("Triggering tilt wave effect")
-                    try:
-                        if leds is not None:
-                            print("Starting exact tilt wave animation")
-                            
-                            # Store current LED colors before starting wave
-                            stored_colors = [(0, 0, 0)] * len(leds)
-                            for i in range(len(leds)):
-                                stored_colors[i] = tuple(leds[i])
-                            
-                            # Enhanced wave colors - exact same as main firmware
-                            WAVE_COLORS = [
-                                (0, 0, 255),      # Deep blue
-                                (0, 100, 255),    # Bright blue
-                                (0, 150, 255),    # Electric blue  
-                                (50, 200, 255),   # Cyan-blue
-                                (100, 220, 255),  # Light electric blue
-                                (150, 240, 255),  # Bright cyan
-                                (200, 250, 255),  # Nearly white-blue
-                                (255, 255, 255),  # Pure white (peak)
-                                (200, 250, 255),  # Bright cyan (fade back)
-                                (150, 240, 255),  # Light electric blue
-                                (100, 220, 255),  # Electric blue
-                                (50, 200, 255),   # Cyan-blue
-                                (0, 150, 255),    # Electric blue
-                                (0, 100, 255),    # Bright blue
-                                (0, 50, 255),     # Deep blue
-                                (0, 25, 128),     # Darker blue
-                                (0, 12, 64),      # Very dark blue
-                                (0, 0, 32),       # Almost off
-                                (0, 0, 0)         # Off
-                            ]
-                            
-                            # Animation parameters - exact same as firmware
-                            tilt_wave_max_steps = 120  # 2.4 seconds
-                            led_count = len(leds)
-                            wave_cycles = 3  # Number of complete sweeps
-                            total_sweep_steps = tilt_wave_max_steps // wave_cycles
-                            tilt_wave_led_counter = 0
-                            
-                            # Perform the exact tilt wave animation algorithm
-                            for tilt_wave_step in range(tilt_wave_max_steps):
-                                # Only update LEDs every 2nd cycle (50Hz from 100Hz)
-                                tilt_wave_led_counter += 1
-                                if tilt_wave_led_counter < 2:
-                                    time.sleep(0.01)  # 100Hz base rate
-                                    continue
-                                tilt_wave_led_counter = 0
-                                
-                                # Calculate wave position - exact algorithm from firmware
-                                current_cycle_step = tilt_wave_step % total_sweep_steps
-                                wave_position = (current_cycle_step * 12) // total_sweep_steps  # 0-11 range
-                                
-                                for led_index in range(led_count):
-                                    # Calculate distance from wave center
-                                    distance = abs(led_index * 2 - wave_position)  # Scale LED positions
-                                    
-                                    # Multiple wave effects - exact algorithm:
-                                    if distance == 0:
-                                        # Direct hit - brightest color
-                                        color_idx = 7  # Pure white peak
-                                    elif distance == 1:
-                                        # Adjacent - very bright
-                                        color_idx = 5 + (current_cycle_step % 3)  # Cycle through bright colors
-                                    elif distance == 2:
-                                        # Near - bright blue
-                                        color_idx = 3 + (current_cycle_step % 2)
-                                    elif distance <= 4:
-                                        # Trailing effect - medium blue
-                                        color_idx = max(0, 4 - distance)
-                                    else:
-                                        # Far from wave - dim or off
-                                        color_idx = 0
-                                    
-                                    # Add sparkle effects on secondary cycles
-                                    cycle_num = tilt_wave_step // total_sweep_steps
-                                    if cycle_num > 0 and (led_index + tilt_wave_step) % 7 == 0:
-                                        color_idx = min(len(WAVE_COLORS) - 1, color_idx + 3)  # Extra brightness
-                                    
-                                    # Clamp color index
-                                    color_idx = min(len(WAVE_COLORS) - 1, max(0, color_idx))
-                                    leds[led_index] = WAVE_COLORS[color_idx]
-                                
-                                leds.show()
-                                time.sleep(0.01)  # 100Hz base timing
-                            
-                            # Restore original colors
-                            for i in range(len(leds)):
-                                leds[i] = stored_colors[i]
-                            leds.show()
-                            
-                            serial.write(b"TILTWAVE:STARTED\n")
-                            print("Exact tilt wave animation completed")
-                        else:
-                            serial.write(b"ERROR: No LEDs available\n")
-                    except Exception as e:
-                        serial.write(f"ERROR: TILTWAVE failed: {e}\n".encode("utf-8"))
-                        print(f"TILTWAVE error: {e}")
+            # Perform the exact tilt wave animation algorithm
+            for tilt_wave_step in range(tilt_wave_max_steps):
+                # Only update LEDs every 2nd cycle (50Hz from 100Hz)
+                tilt_wave_led_counter += 1
+                if tilt_wave_led_counter < 2:
+                    time.sleep(0.01)  # 100Hz base rate
+                    continue
+                tilt_wave_led_counter = 0
 
-                # Handle SETLED:<index>:<r>:<g>:<b> command - set specific LED color
-                elif mode is None and line.startswith("SETLED:"):
-                    try:
-                        parts = line.split(":")
-                        if len(parts) == 5:  # SETLED:index:r:g:b
-                            led_index = int(parts[1])
-                            r = int(parts[2])
-                            g = int(parts[3])
-                            b = int(parts[4])
-                            
-                            if leds and 0 <= led_index < len(leds) and 0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255:
-                                leds[led_index] = (r, g, b)
-                                leds.show()
-                                serial.write(f"SETLED:{led_index}:OK\n".encode("utf-8"))
-                                print(f"LED {led_index} set to ({r},{g},{b})")
-                            else:
-                                serial.write(f"SETLED:{led_index}:ERR\n".encode("utf-8"))
-                        else:
-                            serial.write(f"ERROR: Invalid SETLED format\n".encode("utf-8"))
-                    except Exception as e:
-                        serial.write(f"ERROR: SETLED command failed: {e}\n".encode("utf-8"))
+                # Frame colours come straight from the precomputed table
+                row = tilt_wave_step * led_count
+                if raw_buf is not None:
+                    for led_index in range(led_count):
+                        ci = table[row + led_index] * 3
+                        o = led_index * 3
+                        raw_buf[o:o + 3] = wave_bytes[ci:ci + 3]
+                else:
+                    for led_index in range(led_count):
+                        leds[led_index] = _WAVE_COLORS[table[row + led_index]]
 
-                # Handle LEDRESTORE command - restore normal LED operation
-                elif mode is None and line == "LEDRESTORE":
-                    try:
-                        print("Restoring normal LED operation")
-                        # Force update of LED states based on current button presses
-                        import code
-                        code.update_button_states(config, leds, buttons, current_state, user_presets, preset_colors)
-                        serial.write(b"LEDRESTORE:OK\n")
-                        print("LED restoration complete")
-                    except Exception as e:
-                        serial.write(f"ERROR: LED restore failed: {e}\n".encode("utf-8"))
-                        print(f"LED restore error: {e}")
+                leds.show()
+                time.sleep(0.01)  # 100Hz base timing
+
+            # Restore original colors - bulk slice copy when snapshotted
+            # from the raw buffer
+            if snapshot_buf is not None:
+                snapshot_buf[:] = stored_colors
+            else:
+                for i in range(len(leds)):
+                    leds[i] = stored_colors[i]
+            leds.show()
+
+            serial.write(b"TILTWAVE:STARTED\n")
+            print("Exact tilt wave animation completed")
+        else:
+            serial.write(b"ERROR: No LEDs available\n")
+    except Exception as e:
+        _send_error(serial, b"TILTWAVE failed", e)
+
+def _cmd_ledrestore(serial, env):
+    try:
+        print("Restoring normal LED operation")
+        # Force update of LED states based on current button presses
+        import code
+        code.update_button_states(env["config"], env["leds"], env["buttons"], env["current_state"], env["user_presets"], env["preset_colors"])
+        serial.write(b"LEDRESTORE:OK\n")
+        print("LED restoration complete")
+    except Exception as e:
+        _send_error(serial, b"LED restore failed", e)
+
+def _cmd_rebootbootsel(serial, env):
+    try:
+        serial.write(b" Rebooting to BOOTSEL mode...\n")
+        microcontroller.on_next_reset(microcontroller.RunMode.UF2)
+        microcontroller.reset()
+    except Exception as e:
+        _send_error(serial, b"Failed to reboot to BOOTSEL", e)
+
+def _cmd_reboot(serial, env):
+    try:
+        serial.write(b"Rebooting...\n")
+        microcontroller.reset()
+    except Exception as e:
+        _send_error(serial, b"Failed to reboot", e)
+
+def _cmd_readuid(serial, env):
+    if _DEBUG:
+        print("READUID handler entered")
+    try:
+        # bytes.hex() is one C-level call vs a format + join per byte
+        uid_hex = bytes(microcontroller.cpu.uid).hex().upper()
+        if _DEBUG:
+            print(f"UID: {uid_hex}")
+        serial.write(uid_hex.encode("utf-8") + _SUFFIX_END)
+        if _DEBUG:
+            print("UID sent over serial")
+    except Exception as e:
+        _send_error(serial, None, e, end=True)
+
+# READVERSION support - the version only changes on a flash update, so the
+# regex is compiled once and the reply bytes are cached after the first scan
+# of /code.py (read line by line; the match sits in the first few lines)
+_VERSION_RE = re.compile(r'"code\.py":\s*"([^"]+)"')
+_VERSION_REPLY = None
+
+def _cmd_readversion(serial, env):
+    global _VERSION_REPLY
+    if _DEBUG:
+        print("READVERSION handler entered")
+    try:
+        if _VERSION_REPLY is None:
+            # CRITICAL: Don't import code.py as it causes GPIO conflicts
+            # (GP7 in use) - scan the file for FIRMWARE_VERSIONS instead
+            overall_version = __version__  # Default fallback
+            try:
+                with open("/code.py", "r") as f:
+                    for code_line in f:
+                        match = _VERSION_RE.search(code_line)
+                        if match:
+                            overall_version = match.group(1)
+                            break
+            except Exception as file_error:
+                if _DEBUG:
+                    print(f"File read error, using serial_handler version: {overall_version}, error: {file_error}")
+            _VERSION_REPLY = f"VERSION:{overall_version}\nEND\n".encode("utf-8")
+
+        serial.write(_VERSION_REPLY)
+        if _DEBUG:
+            print(f"Overall firmware version sent: {_VERSION_REPLY}")
+    except Exception as e:
+        _send_error(serial, None, e, end=True)
+
+def _cmd_firmware_ready(serial, env):
+    try:
+        serial.write(b"FIRMWARE_READY:OK\n")
+        if _DEBUG:
+            print("FIRMWARE_READY:OK sent over serial")
+    except Exception as e:
+        _send_error(serial, None, e)
+
+def _cmd_readdevicename(serial, env):
+    try:
+        # Read device name from config.json
+        device_name = "Guitar Controller"  # Default fallback
+        try:
+            with open("/config.json", "r") as f:
+                device_config = json.load(f)
+            device_name = device_config.get("device_name", "Guitar Controller")
+            if _DEBUG:
+                print(f"READDEVICENAME: Loaded device name from config: '{device_name}'")
+        except Exception as config_error:
+            if _DEBUG:
+                print(f"READDEVICENAME: Could not read from config.json, using default: {config_error}")
+
+        # Send the device name (just the user part, not the full interface name)
+        serial.write(device_name.encode("utf-8") + _SUFFIX_END)
+        if _DEBUG:
+            print(f"Device name sent: {device_name}")
+    except Exception as e:
+        _send_error(serial, None, e, end=True)
+
+_EXACT_HANDLERS = {
+    "DEMO": _cmd_demo,
+    "CANCELPINDETECT": _cmd_cancelpindetect,
+    "READWHAMMY": _cmd_readwhammy,
+    "READJOYSTICK": _cmd_readjoystick,
+    "TILTWAVE": _cmd_tiltwave,
+    "LEDRESTORE": _cmd_ledrestore,
+    "REBOOTBOOTSEL": _cmd_rebootbootsel,
+    "REBOOT": _cmd_reboot,
+    "READUID": _cmd_readuid,
+    "READVERSION": _cmd_readversion,
+    "FIRMWARE_READY?": _cmd_firmware_ready,
+    "READY?": _cmd_firmware_ready,
+    "READDEVICENAME": _cmd_readdevicename,
+}
+
+def handle_serial(serial, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors, buffer, mode, filename, file_lines, gp, update_leds, poll_inputs, joystick_x=None, joystick_y=None, max_bytes=8, start_tilt_wave=None):
+    try:
+        # Batched read: drain everything the CDC endpoint has queued in one
+        # read call instead of one read + decode per byte, then peel complete
+        # lines out of the bytearray buffer (max_bytes kept for call
+        # compatibility - reads are no longer capped per invocation)
+        n = serial.in_waiting
+        if not n:
+            return buffer, mode, filename, file_lines, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors
+
+        try:
+            chunk = serial.read(n)
+        except Exception as read_error:
+            print(f"Error reading serial chunk: {read_error}")
+            chunk = None
+        if chunk:
+            buffer.extend(chunk)
 
-                # Handle TILTWAVE_ENABLE:<true/false> command
-                elif mode is None and line.startswith("TILTWAVE_ENABLE:"):
+        while True:
+            idx = buffer.find(b"\n")
+            if idx < 0:
+                return buffer, mode, filename, file_lines, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors
+            line = bytes(buffer[:idx]).decode("utf-8", "replace").rstrip("\r")
+            del buffer[:idx + 1]
+            if _DEBUG:
+                print(f"Received: {line}")
+            
+            # Transfer modes are the hot path during an upload - handle them
+            # before any command parsing so a streamed line costs one string
+            # compare instead of walking every command prefix check below.
+            # HIGH-SPEED streaming write mode - optimized for maximum throughput
+            if mode == "write_stream":
+                if line == "END":
+                    # CRITICAL FIX: Send acknowledgment IMMEDIATELY before file operations
+                    # This ensures Windows app gets success message even if file close fails
+                    if _DEBUG:
+                        print(f"Processing END for {filename} in write_stream mode")
                     try:
-                        enabled_str = line.split(":", 1)[1].strip().lower()
-                        enabled = enabled_str in ("true", "1", "yes", "on")
-                        config["tilt_wave_enabled"] = enabled
-                        import code
-                        code.tilt_wave_enabled = enabled
-                        serial.write(f"TILTWAVE_ENABLE:{enabled}\n".encode("utf-8"))
-                        print(f"Tilt wave {'enabled' if enabled else 'disabled'}")
-                    except Exception as e:
-                        serial.write(f"ERROR: Invalid TILTWAVE_ENABLE command: {e}\n".encode("utf-8"))
-
-                # HIGH-SPEED streaming write mode - optimized for maximum throughput
-                elif mode == "write_stream":
-                    if line == "END":
-                        # CRITICAL FIX: Send acknowledgment IMMEDIATELY before file operations
-                        # This ensures Windows app gets success message even if file close fails
-                        print(f"NEW VERSION v4.0.0 - Processing END for {filename} in write_stream mode")
-                        print(f"DEBUG: Starting END processing at {time.monotonic()}")
-                        try:
-                            # Send completion message FIRST - before any potentially failing operations
-                            print(f"DEBUG: About to send completion acknowledgment...")
-                            serial.write(f"File {filename} written (high-speed streaming)\n".encode("utf-8"))
+                        # Send completion message FIRST - before any potentially failing operations
+                        serial.write(f"File {filename} written (high-speed streaming)\n".encode("utf-8"))
+                        if _DEBUG:
                             print(f"Sent completion acknowledgment for {filename} at {time.monotonic()}")
-                            print(f"DEBUG: Acknowledgment sent successfully!")
-                            
-                            # Now attempt file operations - if these fail, app already got success
-                            if file_lines and hasattr(file_lines[0], 'close'):
-                                print(f"DEBUG: Valid file handle found, attempting flush...")
-                                # Attempt flush with timeout protection
-                                try:
-                                    file_lines[0].flush()
-                                    print(f"Flush completed for {filename} at {time.monotonic()}")
-                                except Exception as flush_error:
-                                    print(f"Flush warning for {filename}: {flush_error}")
-                                    # Continue anyway - data likely already written
-                                
-                                print(f"DEBUG: Attempting file close...")
-                                # Attempt close with timeout protection  
-                                try:
-                                    file_lines[0].close()
-                                    print(f"High-speed streaming write completed for {filename} at {time.monotonic()}")
-                                except Exception as close_error:
-                                    print(f"Close warning for {filename}: {close_error}")
-                                    # File is likely still written correctly
-                            else:
-                                print(f"No valid stream handle for {filename} - but data may be written")
-                                
-                        except Exception as ack_error:
-                            # If even acknowledgment fails, try error message
+                        
+                        # Now attempt file operations - if these fail, app already got success
+                        if file_lines:
+                            # Attempt flush with timeout protection
                             try:
-                                serial.write(f"ERROR: Stream completion error for {filename}: {ack_error}\n".encode("utf-8"))
-                            except:
-                                pass  # Can't do anything if serial write fails
-                            print(f"Critical error in stream completion: {ack_error}")
-                        finally:
-                            # Always cleanup mode and file_lines, even on error
-                            mode = None
-                            file_lines = []
-                            
-                            # Stop write indicator
-                            stop_serial_indicator(leds)
+                                # Spill whatever is left in the accumulator
+                                if file_lines[3]:
+                                    file_lines[0].write(memoryview(file_lines[2])[:file_lines[3]])
+                                    file_lines[3] = 0
+                                file_lines[0].flush()
+                                if _DEBUG:
+                                    print(f"Flush completed for {filename} at {time.monotonic()}")
+                            except Exception as flush_error:
+                                print(f"Flush warning for {filename}: {flush_error}")
+                                # Continue anyway - data likely already written
                             
-                            # Cleanup with protection
+                            # Attempt close with timeout protection  
                             try:
-                                import gc
-                                gc.collect()
-                            except:
-                                pass  # GC failure is not critical
-                    else:
-                        # HIGH-SPEED write: minimal overhead, batched operations
+                                file_lines[0].close()
+                                # One summary print per transfer replaces
+                                # the old per-100-lines progress output
+                                print(f"Streaming write completed for {filename}")
+                            except Exception as close_error:
+                                print(f"Close warning for {filename}: {close_error}")
+                                # File is likely still written correctly
+                        else:
+                            print(f"No valid stream handle for {filename} - but data may be written")
+                            
+                    except Exception as ack_error:
+                        # If even acknowledgment fails, try error message
                         try:
-                            if file_lines and hasattr(file_lines[0], 'write'):
-                                # Fast write with newline
-                                file_lines[0].write(line + "\n")
-                                
-                                # Track lines using file_lines list length (starting from index 1)
-                                if len(file_lines) == 1:  # First line after file handle
-                                    file_lines.append(1)  # Line counter at index 1
-                                    print(f"DEBUG: First line written to {filename}")
-                                else:
-                                    file_lines[1] += 1  # Increment line counter
-                                
-                                line_count = file_lines[1]
-                                
-                                # Debug every 100 lines to track progress
-                                if line_count % 100 == 0:
-                                    print(f"DEBUG: Written {line_count} lines to {filename}")
-                                
-                                # Optimized flush frequency - every 128 lines (~6KB) for speed
-                                if line_count % 128 == 0:
-                                    file_lines[0].flush()
-                                    print(f"DEBUG: Flushed at line {line_count}")
-                                
-                                # Very infrequent GC - only every 40KB to maximize speed
-                                if line_count % 800 == 0:  # ~40KB
-                                    import gc
-                                    gc.collect()
-                                    print(f"DEBUG: GC at line {line_count}")
+                            serial.write(f"ERROR: Stream completion error for {filename}: {ack_error}\n".encode("utf-8"))
+                        except:
+                            pass  # Can't do anything if serial write fails
+                        print(f"Critical error in stream completion: {ack_error}")
+                    finally:
+                        # Always cleanup mode and file_lines, even on error
+                        mode = None
+                        file_lines = []
+                        
+                        # Stop write indicator
+                        stop_serial_indicator(leds)
+                        
+                        # Cleanup with protection
+                        try:
+                            gc.collect()
+                        except:
+                            pass  # GC failure is not critical
+                else:
+                    # HIGH-SPEED write: minimal overhead, batched operations
+                    try:
+                        if file_lines:
+                            # Append to the accumulator; spill to disk when
+                            # it passes the high-water mark (margin left so
+                            # a typical next line still fits). The handle's
+                            # validity is an invariant established at open.
+                            write_fn = file_lines[4]
+                            buf = file_lines[2]
+                            pos = file_lines[3]
+                            b = line.encode("utf-8")
+                            n = len(b)
+                            if pos + n + 1 > len(buf):
+                                if pos:
+                                    write_fn(memoryview(buf)[:pos])
+                                    pos = 0
+                            if n + 1 > len(buf):
+                                # Oversized line - write it through directly
+                                write_fn(b)
+                                write_fn(b"\n")
                             else:
-                                print(f"DEBUG: Invalid stream handle for {filename}")
-                                serial.write(f"ERROR: Invalid stream handle for {filename}\n".encode("utf-8"))
-                                mode = None
-                                file_lines = []
-                        except Exception as stream_write_error:
-                            print(f"Error writing line to stream: {stream_write_error}")
-                            print(f"DEBUG: Stream write error at line: {repr(line[:50])}")
-                            serial.write(f"ERROR: Stream write error: {stream_write_error}\n".encode("utf-8"))
+                                buf[pos:pos + n] = b
+                                pos += n
+                                buf[pos] = 0x0A
+                                pos += 1
+                                if pos >= 3584:
+                                    write_fn(memoryview(buf)[:pos])
+                                    pos = 0
+                            file_lines[3] = pos
+                        else:
+                            serial.write(f"ERROR: Invalid stream handle for {filename}\n".encode("utf-8"))
                             mode = None
                             file_lines = []
+                    except Exception as stream_write_error:
+                        print(f"Error writing line to stream: {stream_write_error}")
+                        serial.write(f"ERROR: Stream write error: {stream_write_error}\n".encode("utf-8"))
+                        mode = None
+                        file_lines = []
 
-                # Write mode logic (original memory-accumulating mode for small files)
-                elif mode == "write":
-                    if line == "END":
-                        try:
-                            # Aggressive pre-write memory cleanup
-                            import gc
-                            line_count = len(file_lines)
-                            if line_count > 20:  # Earlier threshold
-                                gc.collect()
-                                print(f"Pre-write cleanup for {filename}: {line_count} lines")
+                continue
+
+            # Write mode logic (original memory-accumulating mode for small files)
+            if mode == "write":
+                if line == "END":
+                    try:
+                        # The whole transfer sits in one bytearray - no
+                        # list-of-str graph and no full-size join before
+                        # parsing
+                        payload = file_lines[0] if file_lines else bytearray()
+                        if len(payload) > 1024:
+                            # Pre-write cleanup before parse + serialize
+                            gc.collect()
+                        
+                        # Memory-efficient file writing
+                        if filename.endswith(".json"):
+                            # Small JSON files - use full parsing and validation
+                            parsed = json.loads(bytes(payload))
                             
-                            # Memory-efficient file writing
-                            if filename.endswith(".json"):
-                                # Small JSON files - use full parsing and validation
-                                raw = "\n".join(file_lines)
-                                parsed = json.loads(raw)
-                                
-                                # Validation for user_presets.json
-                                if filename == "/user_presets.json":
-                                    if (
-                                        isinstance(parsed, dict) and
-                                        all(
-                                            isinstance(v, dict) and (
-                                                (isinstance(k, str) and (k.lower().startswith("user ") or "preset" in k.lower()))
-                                            )
-                                            for k, v in parsed.items()
-                                        )
-                                    ):
-                                        ensure_parent_dir_exists(filename)
-                                        if atomic_write_json(filename, parsed):
-                                            serial.write(f"File {filename} written (atomic)\n".encode("utf-8"))
-                                            print("File written successfully (user_presets.json, validated)")
-                                            user_presets = parsed
-                                            preset_colors = user_presets.get("NewUserPreset1", {})
-                                        else:
-                                            serial.write(f"ERROR: Atomic write failed for {filename}\n".encode("utf-8"))
-                                    else:
-                                        serial.write(f"ERROR: Invalid user_presets.json structure, write rejected\n".encode("utf-8"))
-                                        print("Invalid user_presets.json structure, write rejected")
-                                elif filename == "/config.json":
+                            # Validation for user_presets.json
+                            if filename == "/user_presets.json":
+                                if _valid_presets(parsed):
                                     ensure_parent_dir_exists(filename)
                                     if atomic_write_json(filename, parsed):
-                                        serial.write(f"File {filename} written (atomic)\n".encode("utf-8"))
-                                        print("Config file written successfully")
-                                        if leds:
-                                            leds.deinit()
-                                        for p in buttons.values():
-                                            try:
-                                                p["obj"].deinit()
-                                            except:
-                                                pass
-                                        if whammy:
-                                            try:
-                                                whammy.deinit()
-                                            except:
-                                                pass
-                                        import microcontroller
-                                        microcontroller.reset()
+                                        serial.write(b"File " + filename.encode("utf-8") + b" written (atomic)\n")
+                                        user_presets = parsed
+                                        preset_colors = user_presets.get("NewUserPreset1", {})
                                     else:
                                         serial.write(f"ERROR: Atomic write failed for {filename}\n".encode("utf-8"))
                                 else:
-                                    # Write re-serialized JSON for other small JSON files with atomic operations
-                                    ensure_parent_dir_exists(filename)
-                                    if atomic_write_json(filename, parsed):
-                                        serial.write(f"File {filename} written (atomic)\n".encode("utf-8"))
-                                        print("JSON file written successfully")
-                                    else:
-                                        serial.write(f"ERROR: Atomic write failed for {filename}\n".encode("utf-8"))
-                                    
-                            else:
-                                # Small non-JSON files - write efficiently
-                                ensure_parent_dir_exists(filename)
-                                with open(filename, "w") as f:
-                                    for i, line in enumerate(file_lines):
-                                        f.write(line)
-                                        if i < len(file_lines) - 1:
-                                            f.write("\n")
-                                    f.write("\n")  # Ensure file ends with newline
-                                serial.write(f"File {filename} written\n".encode("utf-8"))
-                                print(f"File {filename} written successfully ({line_count} lines) - v4.0.0 High-Speed Streaming ⚡")
-
-                        except Exception as e:
-                            serial.write(f"ERROR: Failed to write {filename}: {e}\n".encode("utf-8"))
-                            print("", e)
-                        finally:
-                            # Always cleanup mode and file_lines, even on error
-                            mode = None
-                            file_lines = []
-                            
-                            # Stop write indicator
-                            stop_serial_indicator(leds)
-                            
-                            # Final cleanup
-                            import gc
-                            gc.collect()
-                    else:
-                        try:
-                            file_lines.append(line)
-                            # Light memory protection for small files
-                            line_count = len(file_lines)
-                            if line_count > 30 and line_count % 20 == 0:  # Cleanup every 20 lines after 30
-                                import gc
-                                gc.collect()
-                                print(f"Memory cleanup: {line_count} lines for {filename}")
-                        except Exception as append_error:
-                            print(f"Error appending line to file_lines: {append_error}")
-                            serial.write(f"ERROR: Memory error during file processing: {append_error}\n".encode("utf-8"))
-                            mode = None
-                            file_lines = []
-
-                # 🔧 User preset merge logic
-                elif mode == "merge_user":
-                    if line == "END":
-                        try:
-                            new_data = json.loads("\n".join(file_lines))
-                            try:
-                                with open(filename, "r") as f:
-                                    existing = json.load(f)
-                            except:
-                                existing = {}
-                            # Validation for user_presets.json merge
-                            merged = existing.copy()
-                            merged.update(new_data)
-                            if (
-                                filename == "/user_presets.json" and
-                                isinstance(merged, dict) and
-                                all(
-                                    isinstance(v, dict) and (
-                                        (isinstance(k, str) and (k.lower().startswith("user ") or "preset" in k.lower()))
-                                    )
-                                    for k, v in merged.items()
-                                )
-                            ):
+                                    serial.write(_ERR_PRESETS_WRITE)
+                                    print("Invalid user_presets.json structure, write rejected")
+                            elif filename == "/config.json":
                                 ensure_parent_dir_exists(filename)
-                                if atomic_write_json(filename, merged):
-                                    user_presets = merged
-                                    preset_colors = user_presets.get("NewUserPreset1", {})
-                                    serial.write(f"Merged into {filename} (atomic)\n".encode("utf-8"))
-                                    print("Merge complete (user_presets.json, validated)")
+                                if atomic_write_json(filename, parsed):
+                                    serial.write(b"File " + filename.encode("utf-8") + b" written (atomic)\n")
+                                    if leds:
+                                        leds.deinit()
+                                    for p in buttons.values():
+                                        try:
+                                            p["obj"].deinit()
+                                        except:
+                                            pass
+                                    if whammy:
+                                        try:
+                                            whammy.deinit()
+                                        except:
+                                            pass
+                                    microcontroller.reset()
                                 else:
-                                    serial.write(f"ERROR: Atomic merge write failed for {filename}\n".encode("utf-8"))
+                                    serial.write(f"ERROR: Atomic write failed for {filename}\n".encode("utf-8"))
                             else:
-                                serial.write(f"ERROR: Invalid user_presets.json structure, merge rejected\n".encode("utf-8"))
-                                print("Invalid user_presets.json structure, merge rejected")
-                        except Exception as e:
-                            serial.write(f"ERROR: {e}\n".encode("utf-8"))
-                            print("Merge failed:", e)
+                                # Write re-serialized JSON for other small JSON files with atomic operations
+                                ensure_parent_dir_exists(filename)
+                                if atomic_write_json(filename, parsed):
+                                    serial.write(b"File " + filename.encode("utf-8") + b" written (atomic)\n")
+                                else:
+                                    serial.write(f"ERROR: Atomic write failed for {filename}\n".encode("utf-8"))
+                                
+                        else:
+                            # Small non-JSON files - write the accumulated
+                            # bytes straight out
+                            ensure_parent_dir_exists(filename)
+                            with open(filename, "wb") as f:
+                                f.write(payload)
+                            serial.write(b"File " + filename.encode("utf-8") + b" written\n")
+
+                    except Exception as e:
+                        _send_error(serial, b"Failed to write " + filename.encode("utf-8"), e)
+                    finally:
+                        # Always cleanup mode and file_lines, even on error
+                        mode = None
+                        file_lines = []
                         
-                        # Stop write indicator and cleanup
+                        # Stop write indicator
                         stop_serial_indicator(leds)
+                        
+                        # Final cleanup
+                        gc.collect()
+                else:
+                    try:
+                        # Accumulate into a single bytearray - appending in
+                        # place beats growing a list of str objects
+                        if not file_lines:
+                            file_lines.append(bytearray())
+                        file_lines[0] += line.encode("utf-8")
+                        file_lines[0] += b"\n"
+                    except Exception as append_error:
+                        print(f"Error appending line to file_lines: {append_error}")
+                        serial.write(f"ERROR: Memory error during file processing: {append_error}\n".encode("utf-8"))
                         mode = None
                         file_lines = []
-                    else:
-                        try:
-                            file_lines.append(line)
-                            # Memory protection for merge mode too
-                            if len(file_lines) > 25:  # User presets are typically smaller
-                                import gc
-                                gc.collect()
-                                print(f"Memory cleanup in merge mode: {len(file_lines)} lines")
-                        except Exception as merge_append_error:
-                            print(f"Error appending line in merge mode: {merge_append_error}")
-                            serial.write(f"ERROR: Memory error during merge: {merge_append_error}\n".encode("utf-8"))
-                            mode = None
-                            file_lines = []
 
-                # Handle REBOOTBOOTSEL command
-                elif mode is None and line == "REBOOTBOOTSEL":
-                    try:
-                        import microcontroller
-                        serial.write(b" Rebooting to BOOTSEL mode...\n")
-                        microcontroller.on_next_reset(microcontroller.RunMode.UF2)
-                        microcontroller.reset()
-                    except Exception as e:
-                        serial.write(f"ERROR: Failed to reboot to BOOTSEL: {e}\n".encode("utf-8"))
-                        print("BOOTSEL reboot failed:", e)
-                # Handle REBOOT command
-                elif mode is None and line == "REBOOT":
-                    try:
-                        import microcontroller
-                        serial.write(b"Rebooting...\n")
-                        microcontroller.reset()
-                    except Exception as e:
-                        serial.write(f"ERROR: Failed to reboot: {e}\n".encode("utf-8"))
-                        print("Simple reboot failed:", e)
+                continue
 
-                # Handle MKDIR command
-                elif mode is None and line.startswith("MKDIR:"):
-                    print(f"MKDIR handler entered with line: {line}")
+            # 🔧 User preset merge logic
+            if mode == "merge_user":
+                if line == "END":
                     try:
-                        import os
-                        folder_path = line[6:].strip()  # Remove "MKDIR:" prefix
-                        print(f"Creating directory: {folder_path}")
-                        # CircuitPython uses os.mkdir(), not os.makedirs()
+                        new_data = json.loads(bytes(file_lines[0]) if file_lines else b"")
                         try:
-                            os.mkdir(folder_path)
-                            print(f"Created new directory: {folder_path}")
-                        except OSError as mkdir_error:
-                            # Directory might already exist, which is fine
-                            # Check for various "file exists" error patterns across different systems
-                            error_str = str(mkdir_error).lower()
-                            if (
-                                "eexist" in error_str or 
-                                "file exists" in error_str or 
-                                "exists" in error_str or
-                                "cannot create" in error_str or
-                                mkdir_error.errno == 17  # EEXIST errno
-                            ):
-                                print(f"Directory already exists: {folder_path}")
+                            with open(filename, "r") as f:
+                                existing = json.load(f)
+                        except:
+                            existing = {}
+                        # Validation for user_presets.json merge
+                        # Merge into the freshly-loaded dict in place - copying it
+                        # first doubled peak RAM and the local is discarded (not
+                        # written or published) if validation fails anyway
+                        existing.update(new_data)
+                        merged = existing
+                        if filename == "/user_presets.json" and _valid_presets(merged):
+                            ensure_parent_dir_exists(filename)
+                            if atomic_write_json(filename, merged):
+                                user_presets = merged
+                                preset_colors = user_presets.get("NewUserPreset1", {})
+                                serial.write(b"Merged into " + filename.encode("utf-8") + b" (atomic)\n")
                             else:
-                                # Re-raise for other OS errors
-                                raise mkdir_error
-                        serial.write(f"MKDIR:SUCCESS:{folder_path}\n".encode("utf-8"))
-                        print(f"Directory ready: {folder_path}")
+                                serial.write(f"ERROR: Atomic merge write failed for {filename}\n".encode("utf-8"))
+                        else:
+                            serial.write(_ERR_PRESETS_MERGE)
+                            print("Invalid user_presets.json structure, merge rejected")
                     except Exception as e:
-                        serial.write(f"MKDIR:ERROR:{e}\n".encode("utf-8"))
-                        print(f"Failed to create directory: {e}")
-
-                # Read cpu.uid and pass back
-                elif mode is None and line == "READUID":
-                    print("READUID handler entered")
+                        _send_error(serial, None, e)
+                    
+                    # Stop write indicator and cleanup
+                    stop_serial_indicator(leds)
+                    mode = None
+                    file_lines = []
+                else:
                     try:
-                        import microcontroller
-                        uid_hex = "".join("{:02X}".format(b) for b in microcontroller.cpu.uid)
-                        print(f"UID: {uid_hex}")
-                        serial.write((uid_hex + "\nEND\n").encode("utf-8"))
-                        print("UID sent over serial")
-                    except Exception as e:
-                        serial.write(f"ERROR: {e}\nEND\n".encode("utf-8"))
-                        print(f"Error sending UID: {e}")
+                        if not file_lines:
+                            file_lines.append(bytearray())
+                        file_lines[0] += line.encode("utf-8")
+                        file_lines[0] += b"\n"
+                    except Exception as merge_append_error:
+                        print(f"Error appending line in merge mode: {merge_append_error}")
+                        serial.write(f"ERROR: Memory error during merge: {merge_append_error}\n".encode("utf-8"))
+                        mode = None
+                        file_lines = []
+                continue
+
+            # Smart acknowledgment system - comprehensive for device detection and communication
+            # Skip ACKs only during file write operations to prevent corruption
+            if mode is None:  # Only send ACKs when not in file write mode
+                # Device detection, communication, and control commands need ACKs
+                if line in _ACK_EXACT or line.startswith(_ACK_PREFIXES):
+                    serial.write(_ACK_PREFIX + line[:20].encode("utf-8") + b"\n")
+
+                # Exact-match commands go through the dispatch table - one
+                # dict lookup instead of walking the elif chain below
+                handler = _EXACT_HANDLERS.get(line)
+                if handler is not None:
+                    handler(serial, {
+                        "leds": leds, "config": config, "buttons": buttons,
+                        "whammy": whammy, "joystick_x": joystick_x,
+                        "joystick_y": joystick_y, "current_state": current_state,
+                        "user_presets": user_presets, "preset_colors": preset_colors,
+                        "start_tilt_wave": start_tilt_wave,
+                    })
+                    continue
+
+            # --- Pin Detect Commands ---
+            if mode is None and line.startswith("DETECTPIN:"):
+                button_name = line.split(":", 1)[1].strip()
+                deinit_all_buttons(buttons)
+                serial.write(f"PINDETECT:START:{button_name}\n".encode("utf-8"))
+                detected_pin = detect_pin(button_name, duration=10)
+                if detected_pin:
+                    serial.write(f"PINDETECT:DETECTED:{button_name}:{detected_pin}\n".encode("utf-8"))
+                else:
+                    serial.write(f"PINDETECT:NONE:{button_name}\n".encode("utf-8"))
+                # Reinitialize button pins after detection to avoid crash
+                buttons = setup_buttons(config, raw_config)
+                return buffer, mode, filename, file_lines, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors
+
+            if mode is None and line.startswith("SAVEPIN:"):
+                try:
+                    _, button_name, pin_name = line.split(":", 2)
+                    save_detected_pin("/config.json", button_name, pin_name)
+                    serial.write(f"PINDETECT:SAVED:{button_name}:{pin_name}\n".encode("utf-8"))
+                except Exception as e:
+                    serial.write(f"PINDETECT:ERROR:{e}\n".encode("utf-8"))
+                return buffer, mode, filename, file_lines, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors
 
-                # Handle READVERSION command - return overall firmware version from code.py
-                elif mode is None and line == "READVERSION":
-                    print("READVERSION handler entered")
+            # Preview LED command — always handled
+            if line.startswith("PREVIEWLED:"):
+                try:
+                    _, led_name, hex_color = line.split(":", 2)
+                    led_key = _led_config_key(led_name)
+                    i = config.get(led_key)
+                    if i is not None and leds:
+                        rgb = hex_to_rgb(hex_color)
+                        leds[i] = rgb
+                        leds.show()
+                        print("PREVIEWLED applied")
+                        print(f"led_name: {led_name}, hex_color: {hex_color}")
+                        print(f"led_key: {led_key}, index: {i}, rgb: {rgb}")
+                    else:
+                        print(f"LED not found for key: {led_key}")
+                except Exception as e:
+                    print("PREVIEWLED failed:", e)
+                return buffer, mode, filename, file_lines, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors
+            # Handle READFILE commands
+            if mode is None and line.startswith("READFILE:"):
+                filename = "/" + line.split(":", 1)[1]
+                
+                # Start read indicator (green strum LEDs)
+                start_serial_indicator(leds, 'read')
+                
+                try:
+                    # Send START_<FILENAME> marker
+                    fname = filename.split("/")[-1]
+                    serial.write(f"START_{fname}\n".encode("utf-8"))
+                    # Large files (firmware sources) are streamed through a
+                    # fixed 512-byte buffer with readinto so the whole file
+                    # never has to fit in RAM at once. Small files keep the
+                    # bulk path, which also scrubs stray FIRMWARE_READY:OK
+                    # and blank lines at the bytes level.
+                    if os.stat(filename)[6] > 4096:
+                        with open(filename, "rb") as f:
+                            buf = bytearray(512)
+                            mv = memoryview(buf)
+                            while True:
+                                n = f.readinto(buf)
+                                if not n:
+                                    break
+                                serial.write(mv[:n])
+                    else:
+                        with open(filename, "rb") as f:
+                            payload = f.read()
+                        payload = payload.replace(b"FIRMWARE_READY:OK\n", b"")
+                        while b"\n\n" in payload:
+                            payload = payload.replace(b"\n\n", b"\n")
+                        if payload.startswith(b"\n"):
+                            payload = payload[1:]
+                        if payload:
+                            serial.write(payload)
+                    # Always send END_<FILENAME> marker, even if file is empty or all lines skipped
+                    serial.write(f"END_{fname}\n".encode("utf-8"))
+                except Exception as e:
+                    # On error, still send END_<FILENAME> for protocol consistency
+                    fname = filename.split("/")[-1]
+                    serial.write(f"ERROR: {e}\nEND_{fname}\n".encode("utf-8"))
+                finally:
+                    # Always stop read indicator
+                    stop_serial_indicator(leds)
+            # Handle WRITEFILE commands with HIGH-SPEED streaming mode
+            elif mode is None and line.startswith("WRITEFILE:"):
+                filename = "/" + line.split(":", 1)[1]
+                file_lines = []
+                
+                if _DEBUG:
+                    print(f"DEBUG: WRITEFILE command received for {filename} at {time.monotonic()}")
+                
+                # Start write indicator (red strum LEDs)
+                start_serial_indicator(leds, 'write')
+                
+                # Send initial acknowledgment for WRITEFILE - Windows app expects this
+                serial.write(f"WRITEFILE:READY:{filename.split('/')[-1]}\n".encode("utf-8"))
+                if _DEBUG:
+                    print(f"DEBUG: Sent WRITEFILE:READY for {filename}")
+                
+                # Optimized detection - use high-speed streaming for most Python files
+                fname_lower = filename.lower()
+                use_high_speed_streaming = (
+                    "serial_handler.py" in fname_lower or
+                    "code.py" in fname_lower or
+                    "gamepad.py" in fname_lower or
+                    "hardware.py" in fname_lower or
+                    "utils.py" in fname_lower or
+                    "demo_routine.py" in fname_lower or
+                    "demo_state.py" in fname_lower or
+                    "pin_detect.py" in fname_lower or
+                    "boot.py" in fname_lower or
+                    # Any .py file likely to be >2KB gets streaming
+                    (fname_lower.endswith(".py") and len(fname_lower) > 8)
+                )
+                
+                if use_high_speed_streaming:
+                    mode = "write_stream"
+                    if _DEBUG:
+                        print(f"Starting HIGH-SPEED streaming write to {filename}")
+                    # Send streaming mode acknowledgment
+                    serial.write(f"STREAM:READY:{filename.split('/')[-1]}\n".encode("utf-8"))
+                    if _DEBUG:
+                        print(f"DEBUG: Sent STREAM:READY for {filename}")
+                    # Open file handle immediately for high-speed streaming
                     try:
-                        # CRITICAL: Don't import code.py as it causes GPIO conflicts (GP7 in use)
-                        # Instead, read the FIRMWARE_VERSIONS directly from the file
-                        overall_version = __version__  # Default fallback
-                        
-                        try:
-                            with open("/code.py", "r") as f:
-                                code_content = f.read()
-                            # Parse FIRMWARE_VERSIONS dictionary from code.py
-                            import re
-                            # Look for "code.py": "4.0.0" in FIRMWARE_VERSIONS
-                            match = re.search(r'"code\.py":\s*"([^"]+)"', code_content)
-                            if match:
-                                overall_version = match.group(1)
-                                print(f"Overall firmware version from /code.py file: {overall_version}")
-                            else:
-                                print(f"No code.py version found, using serial_handler version: {overall_version}")
-                        except Exception as file_error:
-                            print(f"File read error, using serial_handler version: {overall_version}, error: {file_error}")
+                        ensure_parent_dir_exists(filename)
+                        stream_file = open(filename, "wb")
+                        # Handle, reserved slot, 4KB accumulator, cursor.
+                        # Incoming lines are batched in the accumulator and
+                        # written in ~4KB chunks - one filesystem write per
+                        # sector-ish block instead of one per line. Flush
+                        # cadence comes straight off the byte cursor, so no
+                        # per-line counter or modulo runs in the hot loop.
+                        # The bound write method rides along so the hot
+                        # loop calls it directly - no hasattr probe or
+                        # attribute resolution per line
+                        file_lines = [stream_file, 0, bytearray(4096), 0, stream_file.write]
+                        if _DEBUG:
+                            print(f"High-speed streaming ready for {filename}")
+                    except Exception as stream_error:
+                        serial.write(f"ERROR: Failed to open stream for {filename}: {stream_error}\n".encode("utf-8"))
+                        mode = "write"  # Fallback to regular mode
+                        file_lines = []
+                else:
+                    mode = "write"
+                    print(f"Starting regular write to {filename}")
+
+            # Handle user preset import
+            elif mode is None and line == "IMPORTUSER":
+                filename = "/user_presets.json"
+                file_lines = []
+                mode = "merge_user"
+                print("Starting IMPORTUSER merge")
+
+            # --- Handle READPIN:<key> for button status ---
+            elif mode is None and line.startswith("READPIN:"):
+                key = line[8:].strip()
+                if _DEBUG:
+                    print(f"[DEBUG] READPIN handler for key: {key}")
+                pin_obj = buttons.get(key)
+                if pin_obj:
+                    serial.write(_pin_response_prefix(key) + (b"0\n" if pin_obj["obj"].value else b"1\n"))
+                else:
+                    if _DEBUG:
+                        print(f"[DEBUG] Pin not found for {key}")
+                    serial.write(_pin_response_prefix(key) + b"ERR\n")
+
+            # Handle SETLED:<index>:<r>:<g>:<b> command - set specific LED color
+            elif mode is None and line.startswith("SETLED:"):
+                try:
+                    parts = line.split(":", 4)
+                    if len(parts) == 5:  # SETLED:index:r:g:b
+                        led_index = int(parts[1])
+                        r = int(parts[2])
+                        g = int(parts[3])
+                        b = int(parts[4])
                         
-                        serial.write(f"VERSION:{overall_version}\nEND\n".encode("utf-8"))
-                        print(f"Overall firmware version sent: {overall_version}")
-                    except Exception as e:
-                        serial.write(f"ERROR: {e}\nEND\n".encode("utf-8"))
-                        print(f"Error sending version: {e}")
+                        if leds and 0 <= led_index < len(leds) and 0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255:
+                            leds[led_index] = (r, g, b)
+                            leds.show()
+                            serial.write(f"SETLED:{led_index}:OK\n".encode("utf-8"))
+                            print(f"LED {led_index} set to ({r},{g},{b})")
+                        else:
+                            serial.write(f"SETLED:{led_index}:ERR\n".encode("utf-8"))
+                    else:
+                        serial.write(_ERR_INVALID_SETLED)
+                except Exception as e:
+                    _send_error(serial, b"SETLED command failed", e)
 
-                # Firmware ready status command
-                elif mode is None and (line == "FIRMWARE_READY?" or line == "READY?"):
-                    try:
-                        serial.write(b"FIRMWARE_READY:OK\n")
-                        print("FIRMWARE_READY:OK sent over serial")
-                    except Exception as e:
-                        serial.write(f"ERROR: {e}\n".encode("utf-8"))
-                        print(f"Error sending FIRMWARE_READY: {e}")
+            # Handle TILTWAVE_ENABLE:<true/false> command
+            elif mode is None and line.startswith("TILTWAVE_ENABLE:"):
+                try:
+                    enabled_str = line.split(":", 1)[1].strip().lower()
+                    enabled = enabled_str in ("true", "1", "yes", "on")
+                    config["tilt_wave_enabled"] = enabled
+                    import code
+                    code.tilt_wave_enabled = enabled
+                    serial.write(f"TILTWAVE_ENABLE:{enabled}\n".encode("utf-8"))
+                    print(f"Tilt wave {'enabled' if enabled else 'disabled'}")
+                except Exception as e:
+                    _send_error(serial, b"Invalid TILTWAVE_ENABLE command", e)
 
-                # Handle READDEVICENAME command
-                elif mode is None and line == "READDEVICENAME":
+            # Handle MKDIR command
+            elif mode is None and line.startswith("MKDIR:"):
+                if _DEBUG:
+                    print(f"MKDIR handler entered with line: {line}")
+                try:
+                    folder_path = line[6:].strip()  # Remove "MKDIR:" prefix
+                    # CircuitPython uses os.mkdir(), not os.makedirs()
                     try:
-                        # Read device name from config.json
-                        device_name = "Guitar Controller"  # Default fallback
-                        try:
-                            with open("/config.json", "r") as f:
-                                config = json.load(f)
-                            device_name = config.get("device_name", "Guitar Controller")
-                            print(f"READDEVICENAME: Loaded device name from config: '{device_name}'")
-                        except Exception as config_error:
-                            print(f"READDEVICENAME: Could not read from config.json, using default: {config_error}")
-                        
-                        # Send the device name (just the user part, not the full interface name)
-                        serial.write((device_name + "\nEND\n").encode("utf-8"))
-                        print(f"Device name sent: {device_name}")
-                    except Exception as e:
-                        serial.write(f"ERROR: {e}\nEND\n".encode("utf-8"))
-                        print(f"Error sending device name: {e}")
-
-                # Fallback error for unknown command
-                elif mode is None:
-                    if line.startswith("READPIN:"):
-                        key = line.split(":", 1)[1].strip()
-                        pin_obj = buttons.get(key)
-                        if pin_obj:
-                            val = int(not pin_obj["obj"].value)
-                            serial.write(f"PIN:{key}:{val}\n".encode("utf-8"))
+                        os.mkdir(folder_path)
+                        if _DEBUG:
+                            print(f"Created new directory: {folder_path}")
+                    except OSError as mkdir_error:
+                        # Directory already existing is fine - EEXIST is
+                        # authoritative, no need to probe the message text
+                        if getattr(mkdir_error, "errno", None) == 17:  # EEXIST
+                            if _DEBUG:
+                                print(f"Directory already exists: {folder_path}")
                         else:
-                            serial.write(f"PIN:{key}:ERR\n".encode("utf-8"))
+                            # Re-raise for other OS errors
+                            raise
+                    serial.write(f"MKDIR:SUCCESS:{folder_path}\n".encode("utf-8"))
+                    if _DEBUG:
+                        print(f"Directory ready: {folder_path}")
+                except Exception as e:
+                    serial.write(f"MKDIR:ERROR:{e}\n".encode("utf-8"))
+
+            # Fallback error for unknown command
+            elif mode is None:
+                if line.startswith("READPIN:"):
+                    key = line[8:].strip()
+                    pin_obj = buttons.get(key)
+                    if pin_obj:
+                        serial.write(_pin_response_prefix(key) + (b"0\n" if pin_obj["obj"].value else b"1\n"))
                     else:
-                        serial.write(b"ERROR: Unknown command\n")
-            else:
-                buffer += char
+                        serial.write(_pin_response_prefix(key) + b"ERR\n")
+                else:
+                    serial.write(_REPLY_UNKNOWN)
     except Exception as e:
         print("Serial handler crashed:", e)
-        serial.write(f"ERROR: Serial crash: {e}\n".encode("utf-8"))
-        buffer = ""
+        _send_error(serial, b"Serial crash", e)
+        # Discard the contents but keep the bytearray - reusing its
+        # capacity avoids a realloc storm if the host causes repeated
+        # transient faults
+        del buffer[:]
         mode = None
         file_lines = []
     return buffer, mode, filename, file_lines, config, raw_config, leds, buttons, whammy, current_state, user_presets, preset_colors
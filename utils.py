@@ -4,13 +4,36 @@ __version__ = "4.0.0"
 def get_version():
     return __version__
 # Utility functions for BGG Firmware
+import json
+import os
+
 import board
 
+# Memoized hex -> RGB results. Config palettes repeat the same few colors
+# across many LEDs, so repeat lookups skip the parse entirely. Bounded so a
+# long-running session can't grow it without limit.
+_HEX_CACHE = {}
+
+# ASCII byte -> hex nibble value, 0xFF marking invalid characters. Parsing a
+# color becomes six table indexings and three shift-ors instead of three
+# int(..., 16) calls through the full int parser.
+_NIB = bytearray(b"\xff" * 256)
+for _i, _c in enumerate(b"0123456789abcdef"):
+    _NIB[_c] = _i
+    if _c >= 0x61:  # also accept the uppercase letter
+        _NIB[_c - 0x20] = _i
+del _i, _c
+
 def hex_to_rgb(hex_color):
     """Convert hex color to RGB tuple. Handles both #ffffff and ffffff formats."""
     if not hex_color:
         return (0, 0, 0)  # Default to black for invalid colors
-    
+
+    rgb = _HEX_CACHE.get(hex_color)
+    if rgb is not None:
+        return rgb
+    key = hex_color
+
     hex_color = hex_color.lstrip("#")
     
     # Ensure we have exactly 6 characters
@@ -18,29 +41,130 @@ def hex_to_rgb(hex_color):
         print(f"Warning: Invalid hex color format '{hex_color}', using black")
         return (0, 0, 0)
     
-    try:
-        return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-    except ValueError:
+    b = hex_color.encode()
+    n0 = _NIB[b[0]]; n1 = _NIB[b[1]]; n2 = _NIB[b[2]]
+    n3 = _NIB[b[3]]; n4 = _NIB[b[4]]; n5 = _NIB[b[5]]
+    if (n0 | n1 | n2 | n3 | n4 | n5) > 0x0F:  # any 0xFF sentinel trips this
         print(f"Warning: Could not parse hex color '{hex_color}', using black")
         return (0, 0, 0)
+    rgb = (n0 << 4 | n1, n2 << 4 | n3, n4 << 4 | n5)
+    if len(_HEX_CACHE) > 256:
+        _HEX_CACHE.clear()
+    _HEX_CACHE[key] = rgb
+    return rgb
 
 def load_config(raw, resolve_pin):
     conf = {}
+    # Branch once on the concrete type per key - type() is cheaper than
+    # repeated isinstance checks, and the first character settles the str
+    # cases without scanning the value twice
+    _str = str
+    _hex = hex_to_rgb
     for key, value in raw.items():
-        if isinstance(value, str) and value.startswith("GP"):
-            conf[key] = resolve_pin(value)
-        elif isinstance(value, list):
+        t = type(value)
+        if t is _str:
+            c0 = value[:1]
+            if c0 == "G" and value.startswith("GP"):
+                conf[key] = resolve_pin(value)
+            elif c0 == "#":
+                conf[key] = _hex(value)
+            else:
+                conf[key] = value
+        elif t is list:
             # Handle color arrays - convert any HEX strings to RGB tuples
-            converted_list = []
-            for v in value:
-                if isinstance(v, str) and (v.startswith("#") or len(v) == 6):
-                    # Handle both "#ffffff" and "ffffff" formats
-                    converted_list.append(hex_to_rgb(v))
-                else:
-                    converted_list.append(v)
-            conf[key] = converted_list
-        elif isinstance(value, str) and value.startswith("#"):
-            conf[key] = hex_to_rgb(value)
+            # (both "#ffffff" and "ffffff" formats)
+            conf[key] = [
+                _hex(v) if type(v) is _str and (v[:1] == "#" or len(v) == 6) else v
+                for v in value
+            ]
+        else:
+            conf[key] = value
+    return conf
+
+# ===== PARSED-CONFIG CACHE =====
+# Warm boots skip the hex/color conversion walk by reusing a cached copy of
+# the converted config, keyed on the source file's (size, mtime) and the
+# firmware version. Pins are stored as their "GP.." names and re-resolved on
+# load (board.Pin objects have no stable serialized form); colors are stored
+# as [r, g, b] lists and re-materialized as tuples.
+_CONFIG_CACHE_PATH = "/config.cache.json"
+
+def _storable_config(raw):
+    """Convert raw config values for caching: colors parsed, pins kept as strings."""
+    _str = str
+    _hex = hex_to_rgb
+    conf = {}
+    for key, value in raw.items():
+        t = type(value)
+        if t is _str:
+            if value[:1] == "#":
+                conf[key] = list(_hex(value))
+            else:
+                conf[key] = value
+        elif t is list:
+            conf[key] = [
+                list(_hex(v)) if type(v) is _str and (v[:1] == "#" or len(v) == 6) else v
+                for v in value
+            ]
         else:
             conf[key] = value
     return conf
+
+def _materialize_config(stored, resolve_pin):
+    """Turn a cached config back into runtime form (resolved pins, RGB tuples)."""
+    _str = str
+    conf = {}
+    for key, value in stored.items():
+        t = type(value)
+        if t is _str:
+            if value[:1] == "G" and value.startswith("GP"):
+                conf[key] = resolve_pin(value)
+            else:
+                conf[key] = value
+        elif t is list:
+            if len(value) == 3 and type(value[0]) is int:
+                conf[key] = tuple(value)
+            else:
+                conf[key] = [
+                    tuple(v) if type(v) is list and len(v) == 3 else v
+                    for v in value
+                ]
+        else:
+            conf[key] = value
+    return conf
+
+def load_config_cached(raw, resolve_pin, path="/config.json"):
+    """load_config with a flash-backed cache of the converted values.
+
+    Falls back to a plain conversion whenever the stat, the cache read or
+    the cache write fails (e.g. filesystem locked by the host), so behavior
+    degrades to load_config rather than erroring.
+    """
+    try:
+        st = os.stat(path)
+        size, mtime = st[6], st[8]
+    except OSError:
+        return load_config(raw, resolve_pin)
+
+    try:
+        with open(_CONFIG_CACHE_PATH, "r") as f:
+            cached = json.load(f)
+        if (
+            cached.get("size") == size
+            and cached.get("mtime") == mtime
+            and cached.get("version") == __version__
+        ):
+            return _materialize_config(cached["conf"], resolve_pin)
+    except Exception:
+        pass  # Missing or stale cache - rebuild below
+
+    stored = _storable_config(raw)
+    try:
+        with open(_CONFIG_CACHE_PATH, "w") as f:
+            json.dump(
+                {"size": size, "mtime": mtime, "version": __version__, "conf": stored},
+                f,
+            )
+    except Exception:
+        pass  # Cache is an optimization; a read-only filesystem is fine
+    return _materialize_config(stored, resolve_pin)